@@ -1,9 +1,19 @@
 # BOT2_PythonAnywhere.py - Refactored Version
 
 import os
+import io
+import re
 import sys
+import time
+import queue
+import atexit
+import collections
 import asyncio
+import logging
+import logging.handlers
 import datetime # Keep as datetime to avoid conflict with datetime class
+from pathlib import Path
+from typing import Final, Optional
 
 # --- Early Global Constants & Setup -----------------------------------------
 # Determine BASE_DIR early for consistent pathing across the script.
@@ -17,19 +27,86 @@ ENV_PATH = os.path.join(BASE_DIR, '.env')
 load_dotenv(ENV_PATH)
 
 # --- Initial Debug Breadcrumbs ----------------------------------------------
-def write_breadcrumb(message, mode="a"):
-    """Helper function to write breadcrumbs to the debug file."""
+# Breadcrumbs are logged with _logger.info("... %s", value). They go through a QueueHandler,
+# so callers (including handlers running on the asyncio event loop) only pay for a
+# queue.put(); message formatting and file I/O happen on the QueueListener's thread.
+class _BufferedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """RotatingFileHandler writing through an 8 KiB BufferedWriter instead of flushing per record.
+
+    The stock shouldRollover() calls stream.seek()/tell(), which drain the buffer on every record,
+    so the file size is tracked here instead."""
+    _bytes_written = 0
+    _pending_bytes = 0
+
+    def _open(self):
+        raw_stream = open(self.baseFilename, self.mode + 'b', buffering=0)
+        self._bytes_written = os.fstat(raw_stream.fileno()).st_size # Non-zero when appending
+        return io.TextIOWrapper(io.BufferedWriter(raw_stream, buffer_size=8192), encoding=self.encoding)
+
+    def shouldRollover(self, record):
+        self._pending_bytes = len(self.format(record).encode(self.encoding or 'utf-8', 'replace')) + len(self.terminator)
+        if self.maxBytes <= 0:
+            return False
+        return self._bytes_written > 0 and self._bytes_written + self._pending_bytes >= self.maxBytes
+
+    def emit(self, record):
+        self._pending_bytes = 0
+        super().emit(record) # May roll over (reopening resets the count) before writing the record
+        self._bytes_written += self._pending_bytes
+
+    def flush(self):
+        # Intentionally a no-op: the buffer is drained when full, on rollover and on close().
+        pass
+
+class _FlowFormatter(logging.Formatter):
+    """Formatter that only re-runs strftime when the second changes; milliseconds are appended directly."""
+    _cached_second = None
+    _cached_prefix = ""
+
+    def formatTime(self, record, datefmt=None):
+        second = int(record.created)
+        if second != self._cached_second: # Only the listener thread formats, so no locking needed
+            self._cached_prefix = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second))
+            self._cached_second = second
+        return f"{self._cached_prefix}.{int(record.msecs):03d}"
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that enqueues records unformatted, so '%s' arguments are merged on the listener thread."""
+    def prepare(self, record):
+        # The stock prepare() formats the message in the caller's thread. Breadcrumb arguments are
+        # ids, names and exceptions that are safe to format later, in the listener thread.
+        return record
+
+_log_queue = queue.SimpleQueue()
+_logger = logging.getLogger("script_flow")
+_logger.setLevel(logging.INFO)
+_logger.propagate = False # Keep breadcrumbs out of any root/PTB logging configuration
+_logger.addHandler(_DeferredQueueHandler(_log_queue))
+
+_flow_file_handler = _BufferedRotatingFileHandler(DEBUG_FLOW_FILE, maxBytes=1 << 20, backupCount=1, encoding='utf-8', delay=True)
+_flow_file_handler.setFormatter(_FlowFormatter("[%(asctime)s] SCRIPT_FLOW: %(message)s"))
+
+_log_listener = logging.handlers.QueueListener(_log_queue, _flow_file_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop) # Drains the queue and closes (flushes) the file on exit
+
+def rotate_flow_log() -> None:
+    """Starts a fresh debug_script_flow.txt, keeping the previous run's file as .1.
+
+    Call only once this process owns the instance lock: another instance may still be writing
+    the file (and on Windows holds it open, so renaming it fails). Breadcrumbs logged before the
+    rotation stay at the end of the previous file."""
+    _flow_file_handler.acquire() # Serialises with emit() on the listener thread
     try:
-        with open(DEBUG_FLOW_FILE, mode, encoding='utf-8') as f_flow:
-            timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-            f_flow.write(f"[{timestamp}] SCRIPT_FLOW: {message}\\n")
-    except Exception as e_flow:
-        # Fallback to print if file writing fails
-        print(f"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] [CRITICAL_BREADCRUMB_ERROR] {message}: {e_flow}", flush=True)
+        _flow_file_handler.doRollover()
+    except OSError as e_rotate: # Keep appending to the existing file instead
+        print(f"WARNING: Could not rotate {DEBUG_FLOW_FILE}: {e_rotate}", file=sys.stderr, flush=True)
+    finally:
+        _flow_file_handler.release()
 
-write_breadcrumb(f"BASE_DIR defined: {BASE_DIR}", mode="w") # Start with "w" to overwrite
-write_breadcrumb(f"Attempting to load .env from: {ENV_PATH}")
-write_breadcrumb(f"load_dotenv called for {ENV_PATH}")
+_logger.info("BASE_DIR defined: %s", BASE_DIR)
+_logger.info("Attempting to load .env from: %s", ENV_PATH)
+_logger.info("load_dotenv called for %s", ENV_PATH)
 
 # --- Environment Variable Loading & Validation ------------------------------
 # These os.getenv calls now happen AFTER load_dotenv() has been called.
@@ -37,17 +114,20 @@ TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 RENDER_APP_BASE_URL = os.getenv('RENDER_APP_BASE_URL', '')  # Default to empty string for optional webhook
 PORT_FROM_ENV = os.getenv('PORT', '8443') # Port for webhook, defaults to 8443
 
-write_breadcrumb(f"After os.getenv calls. TOKEN_LOADED: {'Yes' if TELEGRAM_TOKEN else 'NO!!'}, RENDER_APP_BASE_URL: '{RENDER_APP_BASE_URL}', PORT_FROM_ENV: {PORT_FROM_ENV}")
+_logger.info("After os.getenv calls. TOKEN_LOADED: %s, RENDER_APP_BASE_URL: '%s', PORT_FROM_ENV: %s", 'Yes' if TELEGRAM_TOKEN else 'NO!!', RENDER_APP_BASE_URL, PORT_FROM_ENV)
 
 if not TELEGRAM_TOKEN:
     error_message = "CRITICAL ERROR: TELEGRAM_TOKEN not found. Ensure it is set in your .env file and that load_dotenv() is called correctly before this check."
-    write_breadcrumb(error_message)
+    _logger.info(error_message)
     print(error_message, file=sys.stderr, flush=True)
     raise RuntimeError(error_message)
 
+# Full URL Telegram will call in webhook mode; None means run in polling mode.
+WEBHOOK_URL: Final[Optional[str]] = f"{RENDER_APP_BASE_URL.rstrip('/')}/{TELEGRAM_TOKEN}" if RENDER_APP_BASE_URL else None
+
 # --- Import Third-Party & Local Modules -------------------------------------
 # These imports happen after .env loading and initial variable checks.
-write_breadcrumb("Before main module imports (telegram, instance_lock, etc.)")
+_logger.info("Before main module imports (telegram, instance_lock, etc.)")
 try:
     import telegram
     from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
@@ -60,11 +140,11 @@ try:
         # TypeHandler, # Removed as it was unused
     )
     import telegram.error
-    from instance_lock import InstanceLock
-    write_breadcrumb("Successfully imported main modules.")
+    from instance_lock import InstanceAlreadyRunning, InstanceLock
+    _logger.info("Successfully imported main modules.")
 except ImportError as e_import:
     critical_import_error = f"CRITICAL IMPORT ERROR: Failed to import a required module: {e_import}"
-    write_breadcrumb(critical_import_error)
+    _logger.info(critical_import_error)
     print(critical_import_error, file=sys.stderr, flush=True)
     raise  # Re-raise the import error to halt execution
 
@@ -80,10 +160,28 @@ SUBJECTS = {
     "JAVA": "Java Programming"
 }
 
+# Per-section ("notes" / "papers") data roots and subject prompts
+DATA_PATHS = {"notes": NOTES_DATA_PATH, "papers": PAPERS_DATA_PATH}
+SUBJECT_PROMPTS = {
+    "notes": "📚 Please select a subject for notes:",
+    "papers": "📝 Please select a subject for papers:"
+}
+
+# Welcome / main-menu text shared by /start and the 'Back to Main Menu' buttons
+START_MESSAGE_TEMPLATE = (
+    "Hi {mention}! Welcome to the ECE Resource Bot.\n\n"
+    "You can use me to get Notes or Previous Year Papers.\n\n"
+    "Available commands:\n"
+    "/notes - Get lecture notes\n"
+    "/papers - Get previous year question papers\n"
+    "/help - Show this help message"
+)
+
+SENDABLE_EXTENSIONS = ('.pdf', '.doc', '.docx', '.txt', '.zip', '.rar', '.jpg', '.png')
+
 # --- Helper Functions -------------------------------------------------------
-def build_subject_keyboard(action_prefix: str) -> InlineKeyboardMarkup:
+def _make_subject_keyboard(action_prefix: str) -> InlineKeyboardMarkup:
     """Builds an inline keyboard with subjects for notes or papers."""
-    write_breadcrumb(f"Building subject keyboard for action_prefix: {action_prefix}")
     keyboard = [
         # Callback changes to e.g. "notes_showmodules_ACS"
         [InlineKeyboardButton(name, callback_data=f"{action_prefix}_showmodules_{code}")]
@@ -93,25 +191,129 @@ def build_subject_keyboard(action_prefix: str) -> InlineKeyboardMarkup:
     keyboard.append([InlineKeyboardButton("🔙 Back to Main Menu", callback_data="start_menu")])
     return InlineKeyboardMarkup(keyboard)
 
-def build_module_keyboard(action_prefix: str, subject_code: str) -> InlineKeyboardMarkup:
+def _make_module_keyboard(action_prefix: str, subject_code: str) -> InlineKeyboardMarkup:
     """Builds an inline keyboard with modules (1-5) for a selected subject."""
-    write_breadcrumb(f"Building module keyboard for action: {action_prefix}, subject: {subject_code}")
-    keyboard = []
-    row = []
-    for i in range(1, 6):  # Modules 1 to 5
-        button_text = f"Module {i}"
-        # Callback e.g. "notes_getfiles_ACS_1" or "papers_getfiles_AIML_3"
-        callback_data = f"{action_prefix}_getfiles_{subject_code}_{i}"
-        row.append(InlineKeyboardButton(button_text, callback_data=callback_data))
-        if len(row) == 2 or i == 5: # Max 2 buttons per row, or if it's the last module
-            keyboard.append(row)
-            row = []
-    
+    # Modules 1 to 5; callback e.g. "notes_getfiles_ACS_1" or "papers_getfiles_AIML_3"
+    buttons = [
+        InlineKeyboardButton(f"Module {i}", callback_data=f"{action_prefix}_getfiles_{subject_code}_{i}")
+        for i in range(1, 6)
+    ]
+    keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)] # Max 2 buttons per row
+
     # Callback e.g. "notes_showsubjects" (action_prefix determines if it's notes or papers)
     keyboard.append([InlineKeyboardButton("🔙 Back to Subjects", callback_data=f"{action_prefix}_showsubjects")])
     keyboard.append([InlineKeyboardButton("🏠 Back to Main Menu", callback_data="start_menu")]) # Add main menu button
     return InlineKeyboardMarkup(keyboard)
 
+# Keyboards only depend on static data (SUBJECTS), so build every variant once at import
+# and hand out the same markup objects from the handlers.
+_SUBJECT_KB = {prefix: _make_subject_keyboard(prefix) for prefix in ("notes", "papers")}
+_MODULE_KB = {
+    (prefix, code): _make_module_keyboard(prefix, code)
+    for prefix in ("notes", "papers")
+    for code in SUBJECTS
+}
+
+def build_subject_keyboard(action_prefix: str) -> InlineKeyboardMarkup:
+    """Returns the precomputed subject keyboard for notes or papers."""
+    return _SUBJECT_KB[action_prefix]
+
+def build_module_keyboard(action_prefix: str, subject_code: str) -> InlineKeyboardMarkup:
+    """Returns the precomputed module (1-5) keyboard for a selected subject."""
+    return _MODULE_KB[(action_prefix, subject_code)]
+
+# Module folders rarely change, so their filtered file lists are memoized and only
+# rebuilt when the directory's mtime changes: {path: (st_mtime_ns, [file paths])}
+_dir_cache = {}
+
+def list_module_files(module_path: str) -> list:
+    """Returns the sorted paths of sendable files in a module folder, using the mtime-keyed cache."""
+    mtime_ns = os.stat(module_path).st_mtime_ns
+    cached = _dir_cache.get(module_path)
+    if cached is not None and cached[0] == mtime_ns:
+        return cached[1]
+
+    # scandir's DirEntry carries the file type and full path from the directory read itself
+    with os.scandir(module_path) as dir_entries:
+        entries = [entry for entry in dir_entries if entry.is_file() and entry.name.lower().endswith(SENDABLE_EXTENSIONS)]
+    entries.sort(key=lambda entry: entry.name)
+    all_files = [entry.path for entry in entries]
+    _dir_cache[module_path] = (mtime_ns, all_files)
+    _logger.info("list_module_files: Cached %s file(s) for %s", len(all_files), module_path)
+    return all_files
+
+
+# Telegram copes with a few parallel uploads per bot; more than that invites flood-wait errors.
+# Each module is sent one file at a time (to keep filename order), so this caps uploads across chats.
+MAX_CONCURRENT_UPLOADS = 4
+_upload_semaphore = asyncio.Semaphore(MAX_CONCURRENT_UPLOADS)
+
+# Telegram file_id of documents that were already uploaded, keyed by (path, st_mtime_ns).
+# Sending a known file_id makes Telegram re-use its stored copy instead of receiving the bytes again.
+_file_id_cache = {}
+
+def start_document_read(file_path: str) -> Optional[asyncio.Task]:
+    """Starts reading a file's bytes on a worker thread, unless its cached file_id will be sent instead."""
+    try:
+        cache_key = (file_path, os.stat(file_path).st_mtime_ns)
+    except OSError:
+        return None # upload_document() reports the error when this file's turn comes
+    if cache_key in _file_id_cache:
+        return None
+    return asyncio.create_task(asyncio.to_thread(Path(file_path).read_bytes))
+
+async def upload_document(chat_id: int, file_path: str, file_name: str, context: ContextTypes.DEFAULT_TYPE, read_task: Optional[asyncio.Task] = None) -> None:
+    """Sends a document, re-using its cached file_id if this exact file was uploaded before."""
+    cache_key = (file_path, os.stat(file_path).st_mtime_ns)
+    cached_file_id = _file_id_cache.get(cache_key)
+    if cached_file_id is not None:
+        try:
+            await context.bot.send_document(chat_id=chat_id, document=cached_file_id)
+            return
+        except telegram.error.BadRequest as e_bad_id:
+            _logger.info("upload_document: Cached file_id for %s rejected (%s). Uploading again.", file_name, e_bad_id)
+            _file_id_cache.pop(cache_key, None)
+
+    # Read the file on a worker thread; a file object would be read on the event loop while PTB builds the request.
+    # A read_task from start_document_read() may already have loaded it while the previous file was uploading.
+    document_bytes = await (read_task if read_task is not None else asyncio.to_thread(Path(file_path).read_bytes))
+    sent_message = await context.bot.send_document(chat_id=chat_id, document=document_bytes, filename=file_name)
+    _file_id_cache[cache_key] = sent_message.document.file_id
+
+async def send_single_file(chat_id: int, file_path: str, context: ContextTypes.DEFAULT_TYPE, read_task: Optional[asyncio.Task] = None) -> bool:
+    """Uploads one file to the user, retrying once on network errors. Returns True if it was sent."""
+    file_name = os.path.basename(file_path)
+    async with _upload_semaphore:
+        file_send_start_time = datetime.datetime.now()
+        try:
+            await upload_document(chat_id, file_path, file_name, context, read_task)
+            file_send_duration = (datetime.datetime.now() - file_send_start_time).total_seconds()
+            _logger.info("send_single_file: Sent %s to chat_id %s in %.2fs", file_name, chat_id, file_send_duration)
+            return True
+        except telegram.error.NetworkError as e_net:
+            _logger.info("send_single_file: NetworkError sending %s: %s. Retrying once...", file_name, e_net)
+            await asyncio.sleep(1) # Brief pause before retry
+            try:
+                await upload_document(chat_id, file_path, file_name, context, read_task)
+                _logger.info("send_single_file: Successfully sent %s on retry.", file_name)
+                return True
+            except Exception as e_retry:
+                _logger.info("send_single_file: Failed to send %s on retry: %s", file_name, e_retry)
+                return False
+        except Exception as e_gen:
+            _logger.info("send_single_file: Generic error sending %s: %s", file_name, e_gen)
+            return False
+
+
+async def keep_upload_action_alive(chat_id: int, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Re-posts the 'sending file...' chat action until cancelled (Telegram clears it after ~5s)."""
+    while True:
+        try:
+            await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.UPLOAD_DOCUMENT)
+        except telegram.error.TelegramError as e_action:
+            _logger.info("keep_upload_action_alive: Failed to send chat action to chat_id %s: %s", chat_id, e_action)
+        await asyncio.sleep(4)
+
 
 async def send_module_files(chat_id: int, base_data_path: str, subject_code: str, module_number: str, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Sends all files from a specific subject and module folder to the user."""
@@ -120,75 +322,87 @@ async def send_module_files(chat_id: int, base_data_path: str, subject_code: str
     specific_module_path = os.path.join(base_data_path, subject_code, module_folder_name)
     subject_name = SUBJECTS.get(subject_code, subject_code)
 
-    write_breadcrumb(f"send_module_files: Initiated for chat_id {chat_id}, subject: {subject_code}, module: {module_number}. Path: {specific_module_path}")
+    _logger.info("send_module_files: Initiated for chat_id %s, subject: %s, module: %s. Path: %s", chat_id, subject_code, module_number, specific_module_path)
 
-    if not os.path.isdir(specific_module_path):
-        write_breadcrumb(f"send_module_files: Module folder not found: {specific_module_path}")
+    try:
+        all_files = list_module_files(specific_module_path)
+    except (FileNotFoundError, NotADirectoryError):
+        _logger.info("send_module_files: Module folder not found: %s", specific_module_path)
         await context.bot.send_message(chat_id=chat_id, text=f"❌ Error: Content folder not found for {subject_name} - {module_folder_name}.\nExpected path: {specific_module_path}")
         return
 
-    all_files = []
-    for filename in sorted(os.listdir(specific_module_path)):
-        if filename.lower().endswith(('.pdf', '.doc', '.docx', '.txt', '.zip', '.rar', '.jpg', '.png')):
-            all_files.append(os.path.join(specific_module_path, filename))
-
     if not all_files:
-        write_breadcrumb(f"send_module_files: No suitable files found in {specific_module_path}")
+        _logger.info("send_module_files: No suitable files found in %s", specific_module_path)
         await context.bot.send_message(chat_id=chat_id, text=f"📭 No suitable files found for {subject_name} - {module_folder_name}.")
         return
 
-    await context.bot.send_message(chat_id=chat_id, text=f"Found {len(all_files)} file(s) for {subject_name} - {module_folder_name}. Starting upload...")
-    write_breadcrumb(f"send_module_files: Found {len(all_files)} files for {subject_name} - {module_folder_name}. User notified.")
-
-    for file_path in all_files:
-        file_name = os.path.basename(file_path)
-        file_send_start_time = datetime.datetime.now()
-        try:
-            await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.UPLOAD_DOCUMENT)
-            with open(file_path, "rb") as f_doc:
-                await context.bot.send_document(chat_id=chat_id, document=f_doc, filename=file_name)
-            file_send_duration = (datetime.datetime.now() - file_send_start_time).total_seconds()
-            write_breadcrumb(f"send_module_files: Sent {file_name} to chat_id {chat_id} in {file_send_duration:.2f}s")
-        except telegram.error.NetworkError as e_net:
-            write_breadcrumb(f"send_module_files: NetworkError sending {file_name}: {e_net}. Retrying once...")
-            await asyncio.sleep(1) # Brief pause before retry
-            try:
-                with open(file_path, 'rb') as f_doc_retry:
-                    await context.bot.send_document(chat_id=chat_id, document=f_doc_retry, filename=file_name)
-                write_breadcrumb(f"send_module_files: Successfully sent {file_name} on retry.")
-            except Exception as e_retry:
-                write_breadcrumb(f"send_module_files: Failed to send {file_name} on retry: {e_retry}")
-                await context.bot.send_message(chat_id=chat_id, text=f"⚠️ Failed to send {file_name} after a retry.")
-        except Exception as e_gen:
-            write_breadcrumb(f"send_module_files: Generic error sending {file_name}: {e_gen}")
-            await context.bot.send_message(chat_id=chat_id, text=f"⚠️ An error occurred while sending {file_name}.")
+    _logger.info("send_module_files: Found %s files for %s - %s. Starting upload.", len(all_files), subject_name, module_folder_name)
 
-    await context.bot.send_message(chat_id=chat_id, text=f"✅ All files sent for {subject_name} - {module_folder_name}!")
+    # One background task keeps the upload indicator visible for the whole batch, instead of
+    # a send_chat_action call before every file.
+    upload_action_task = asyncio.create_task(keep_upload_action_alive(chat_id, context))
+    failed_files = []
+    next_read_task = start_document_read(all_files[0])
+    try:
+        # Documents are sent one at a time so they arrive in filename order; only the next
+        # file's read from disk overlaps with the current upload.
+        for file_index, file_path in enumerate(all_files):
+            read_task = next_read_task
+            next_read_task = start_document_read(all_files[file_index + 1]) if file_index + 1 < len(all_files) else None
+            if not await send_single_file(chat_id, file_path, context, read_task):
+                failed_files.append(os.path.basename(file_path))
+    finally:
+        upload_action_task.cancel()
+        if next_read_task is not None:
+            next_read_task.cancel() # Only reached if the loop was interrupted
+
+    if failed_files:
+        await context.bot.send_message(chat_id=chat_id, text=f"⚠️ Sent {len(all_files) - len(failed_files)} of {len(all_files)} file(s) for {subject_name} - {module_folder_name}.\nFailed: {', '.join(failed_files)}")
+    else:
+        await context.bot.send_message(chat_id=chat_id, text=f"✅ All files sent for {subject_name} - {module_folder_name}!")
     operation_duration = (datetime.datetime.now() - operation_start_time).total_seconds()
-    write_breadcrumb(f"send_module_files: Completed for chat_id {chat_id} for {subject_name} - {module_folder_name}. Duration: {operation_duration:.2f}s")
+    _logger.info("send_module_files: Completed for chat_id %s for %s - %s. Duration: %.2fs", chat_id, subject_name, module_folder_name, operation_duration)
+
+# Last (text, markup id) shown per (chat_id, message_id). Keyboards are cached singletons, so
+# their id() identifies them. A repeated press of the same navigation button would otherwise
+# cost a round-trip that Telegram rejects with "Message is not modified".
+_last_view = collections.OrderedDict()
+LAST_VIEW_CACHE_SIZE = 1024
+
+async def edit_view(query, text: str, reply_markup=None, **kwargs) -> bool:
+    """Edits the callback's message unless it already shows this exact text and keyboard.
+
+    Returns False when the edit was skipped, e.g. for a repeated tap on the same button."""
+    view_key = (query.message.chat.id, query.message.message_id) if query.message else None
+    view = (text, id(reply_markup))
+    if view_key is not None and _last_view.get(view_key) == view:
+        _logger.info("edit_view: Message %s already shows this view. Skipping edit.", view_key)
+        return False
+
+    await query.edit_message_text(text=text, reply_markup=reply_markup, **kwargs)
+    if view_key is not None:
+        _last_view[view_key] = view
+        _last_view.move_to_end(view_key)
+        if len(_last_view) > LAST_VIEW_CACHE_SIZE:
+            _last_view.popitem(last=False) # Evict the least recently shown view
+    return True
+
 
 # --- Command Handlers -------------------------------------------------------
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
-    message_text = (
-        f"Hi {user.mention_html()}! Welcome to the ECE Resource Bot.\n\n"
-        "You can use me to get Notes or Previous Year Papers.\n\n"
-        "Available commands:\n"
-        "/notes - Get lecture notes\n"
-        "/papers - Get previous year question papers\n"
-        "/help - Show this help message"
-    )
+    message_text = START_MESSAGE_TEMPLATE.format(mention=user.mention_html())
     if update.callback_query: # Called from a button like 'Back to Main Menu'
         query = update.callback_query # Define query from update
         await query.answer() # Acknowledge callback first
-        await query.edit_message_text(text=message_text, reply_markup=None, parse_mode='HTML')
-        write_breadcrumb(f"Callback 'start_menu': User {user.id} ({user.first_name})")
+        await edit_view(query, message_text, parse_mode='HTML')
+        _logger.info("Callback 'start_menu': User %s (%s)", user.id, user.first_name)
     else: # Called directly via /start command
         await update.message.reply_html(message_text)
-        write_breadcrumb(f"Command /start: User {user.id} ({user.first_name})")
+        _logger.info("Command /start: User %s (%s)", user.id, user.first_name)
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    write_breadcrumb(f"Command /help: User {update.effective_user.id}")
+    _logger.info("Command /help: User %s", update.effective_user.id)
     await update.message.reply_text(
         "Available commands:\n"
         "/start - Welcome message\n"
@@ -198,87 +412,97 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     )
 
 async def notes_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    write_breadcrumb(f"Command /notes: User {update.effective_user.id}")
+    _logger.info("Command /notes: User %s", update.effective_user.id)
     # build_subject_keyboard now generates 'notes_showmodules_CODE' callbacks
     keyboard = build_subject_keyboard("notes") 
-    await update.message.reply_text("📚 Please select a subject for notes:", reply_markup=keyboard)
+    await update.message.reply_text(SUBJECT_PROMPTS["notes"], reply_markup=keyboard)
 
 async def papers_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    write_breadcrumb(f"Command /papers: User {update.effective_user.id}")
+    _logger.info("Command /papers: User %s", update.effective_user.id)
     # build_subject_keyboard now generates 'papers_showmodules_CODE' callbacks
     keyboard = build_subject_keyboard("papers") 
-    await update.message.reply_text("📝 Please select a subject for papers:", reply_markup=keyboard)
+    await update.message.reply_text(SUBJECT_PROMPTS["papers"], reply_markup=keyboard)
 
 # --- Callback Query Handler -------------------------------------------------
+# Callback data looks like "start_menu", "notes_showsubjects", "notes_showmodules_ACS" or
+# "papers_getfiles_AIML_3". A single compiled match splits it into named parts, and
+# (prefix, command) selects the branch from _CALLBACK_DISPATCH below.
+_CALLBACK_DATA_RE = re.compile(
+    r"^(?P<prefix>notes|papers|start)_(?P<command>showmodules|showsubjects|getfiles|menu)"
+    r"(?:_(?P<subject>[A-Z]+))?(?:_(?P<module>\d+))?$"
+)
+
+async def _callback_invalid_selection(query, data: str) -> None:
+    await edit_view(query, "Sorry, I didn't understand that selection or it's invalid. Please try again.")
+    _logger.info("CallbackQuery: Unhandled or invalid data structure: %s", data)
+
+async def _callback_main_menu(match: re.Match, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """start_menu: triggered by the 'Back to Main Menu' buttons."""
+    user = update.effective_user
+    message_text = START_MESSAGE_TEMPLATE.format(mention=user.mention_html())
+    await edit_view(update.callback_query, message_text, parse_mode='HTML')
+    _logger.info("Callback 'start_menu': Displayed main menu for User %s", user.id)
+
+async def _callback_show_subjects(match: re.Match, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """e.g. notes_showsubjects (from 'Back to Subjects')."""
+    action_prefix = match["prefix"]
+    await edit_view(update.callback_query, SUBJECT_PROMPTS[action_prefix], reply_markup=build_subject_keyboard(action_prefix))
+    _logger.info("Callback '%s': Displayed subject keyboard for %s", match.string, action_prefix)
+
+async def _callback_show_modules(match: re.Match, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """e.g. notes_showmodules_ACS (from a subject button)."""
+    action_prefix, subject_code = match["prefix"], match["subject"]
+    if (subject_name := SUBJECTS.get(subject_code)) is None:
+        await _callback_invalid_selection(update.callback_query, match.string)
+        return
+    keyboard = build_module_keyboard(action_prefix, subject_code)
+    await edit_view(update.callback_query, f"Selected: {subject_name}\n🔢 Please select a module for {action_prefix}:", reply_markup=keyboard)
+    _logger.info("Callback '%s': Displayed module keyboard for %s, %s", match.string, action_prefix, subject_code)
+
+async def _callback_get_files(match: re.Match, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """e.g. notes_getfiles_ACS_1 (from a module button)."""
+    action_prefix, subject_code, module_number = match["prefix"], match["subject"], match["module"]
+    if (subject_name := SUBJECTS.get(subject_code)) is None or not module_number:
+        await _callback_invalid_selection(update.callback_query, match.string)
+        return
+    if not await edit_view(update.callback_query, f"Fetching {action_prefix} for {subject_name} - Module {module_number}..."):
+        # Already fetching/fetched for this message: a double-tap must not send the module twice
+        _logger.info("Callback '%s': Duplicate tap ignored.", match.string)
+        return
+    # send_module_files sends its own completion message.
+    await send_module_files(update.effective_chat.id, DATA_PATHS[action_prefix], subject_code, module_number, context)
+    _logger.info("Callback '%s': Triggered file sending for %s, %s, Module %s", match.string, action_prefix, subject_code, module_number)
+
+_CALLBACK_DISPATCH = {
+    ("start", "menu"): _callback_main_menu,
+    ("notes", "showsubjects"): _callback_show_subjects,
+    ("papers", "showsubjects"): _callback_show_subjects,
+    ("notes", "showmodules"): _callback_show_modules,
+    ("papers", "showmodules"): _callback_show_modules,
+    ("notes", "getfiles"): _callback_get_files,
+    ("papers", "getfiles"): _callback_get_files,
+}
+
 async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer() # Acknowledge callback
     data = query.data
-    chat_id = query.effective_chat.id
-    user_id = query.effective_user.id
-
-    write_breadcrumb(f"CallbackQuery: User {user_id}, Data: {data}")
-
-    parts = data.split('_')
-    action_prefix = parts[0] # 'notes', 'papers', or 'start'
-    command = parts[1] if len(parts) > 1 else None
-    subject_code = parts[2] if len(parts) > 2 else None
-    module_number = parts[3] if len(parts) > 3 else None
-
-    if action_prefix == "start" and command == "menu":
-        # This is triggered by 'Back to Main Menu' buttons
-        # Re-use start_command logic, but ensure it edits the message
-        # For simplicity, directly call the text/reply_markup part here or refactor start_command
-        message_text = (
-            f"Hi {query.effective_user.mention_html()}! Welcome to the ECE Resource Bot.\n\n"
-            "You can use me to get Notes or Previous Year Papers.\n\n"
-            "Available commands:\n"
-            "/notes - Get lecture notes\n"
-            "/papers - Get previous year question papers\n"
-            "/help - Show this help message"
-        )
-        await query.edit_message_text(text=message_text, reply_markup=None, parse_mode='HTML')
-        write_breadcrumb(f"Callback 'start_menu': Displayed main menu for User {user_id}")
-        return
 
-    if action_prefix in ["notes", "papers"]:
-        current_data_path_root = NOTES_DATA_PATH if action_prefix == "notes" else PAPERS_DATA_PATH
-        text_prompt_subject = "📚 Please select a subject for notes:" if action_prefix == "notes" else "📝 Please select a subject for papers:"
-        
-        if command == "showsubjects": # e.g. notes_showsubjects (from 'Back to Subjects')
-            keyboard = build_subject_keyboard(action_prefix)
-            await query.edit_message_text(text=text_prompt_subject, reply_markup=keyboard)
-            write_breadcrumb(f"Callback '{data}': Displayed subject keyboard for {action_prefix}")
-        
-        elif command == "showmodules" and subject_code in SUBJECTS:
-            # e.g. notes_showmodules_ACS (from subject button or /notes -> subject)
-            keyboard = build_module_keyboard(action_prefix, subject_code)
-            subject_name = SUBJECTS[subject_code]
-            await query.edit_message_text(text=f"Selected: {subject_name}\n🔢 Please select a module for {action_prefix}:", reply_markup=keyboard)
-            write_breadcrumb(f"Callback '{data}': Displayed module keyboard for {action_prefix}, {subject_code}")
-
-        elif command == "getfiles" and subject_code in SUBJECTS and module_number:
-            # e.g. notes_getfiles_ACS_1 (from module button)
-            subject_name = SUBJECTS[subject_code]
-            await query.edit_message_text(text=f"Fetching {action_prefix} for {subject_name} - Module {module_number}...")
-            await send_module_files(chat_id, current_data_path_root, subject_code, module_number, context)
-            # After sending files, perhaps offer to go back to modules or subjects?
-            # For now, send_module_files sends a completion message.
-            write_breadcrumb(f"Callback '{data}': Triggered file sending for {action_prefix}, {subject_code}, Module {module_number}")
-        
-        else:
-            await query.edit_message_text(text="Sorry, I didn't understand that selection or it's invalid. Please try again.")
-            write_breadcrumb(f"CallbackQuery: Unhandled or invalid data structure for {action_prefix}: {data}")
-    else:
-        await query.edit_message_text(text="Sorry, an unexpected error occurred with your selection.")
-        write_breadcrumb(f"CallbackQuery: Unhandled action_prefix: {data}")
+    _logger.info("CallbackQuery: User %s, Data: %s", update.effective_user.id, data)
+
+    match = _CALLBACK_DATA_RE.match(data)
+    callback_handler = _CALLBACK_DISPATCH.get((match["prefix"], match["command"])) if match else None
+    if callback_handler is None:
+        await _callback_invalid_selection(query, data)
+        return
+    await callback_handler(match, update, context)
 
 
 # --- Error Handler ----------------------------------------------------------
 async def error_handler_telegram(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Logs errors caused by Updates."""
     error_message = f"Telegram Update {update} caused error: {context.error}"
-    write_breadcrumb(f"ERROR_HANDLER: {error_message}")
+    _logger.info("ERROR_HANDLER: %s", error_message)
     print(error_message, file=sys.stderr, flush=True) # Also print to console for visibility
 
     if isinstance(context.error, telegram.error.NetworkError):
@@ -287,21 +511,30 @@ async def error_handler_telegram(update: object, context: ContextTypes.DEFAULT_T
             try:
                 await context.bot.send_message(chat_id=update.effective_chat.id, text="A network error occurred. Please try again later.")
             except Exception as e_send:
-                write_breadcrumb(f"ERROR_HANDLER: Failed to send network error notification: {e_send}")
+                _logger.info("ERROR_HANDLER: Failed to send network error notification: %s", e_send)
     # Add more specific error handling as needed
 
 # --- Main Application Logic -------------------------------------------------
 def run_bot() -> None:
     """Sets up and runs the Telegram bot."""
-    write_breadcrumb("run_bot: Initializing bot application...")
+    _logger.info("run_bot: Initializing bot application...")
     
     try:
         port_to_use = int(PORT_FROM_ENV)
     except ValueError:
-        write_breadcrumb(f"run_bot: Invalid PORT_FROM_ENV value '{PORT_FROM_ENV}'. Defaulting to 8443.")
+        _logger.info("run_bot: Invalid PORT_FROM_ENV value '%s'. Defaulting to 8443.", PORT_FROM_ENV)
         port_to_use = 8443
 
-    application = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    # Keep-alive HTTP connections are reused from the pool instead of re-handshaking TLS per
+    # request; the pool is sized for MAX_CONCURRENT_UPLOADS uploads plus regular API calls.
+    application = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .connection_pool_size(16)
+        .pool_timeout(5.0)
+        .get_updates_pool_timeout(60)
+        .build()
+    )
 
     # Register handlers
     application.add_handler(CommandHandler("start", start_command))
@@ -312,76 +545,60 @@ def run_bot() -> None:
 
     application.add_error_handler(error_handler_telegram)
 
-    write_breadcrumb("run_bot: Bot application handlers configured.")
+    _logger.info("run_bot: Bot application handlers configured.")
 
-    if RENDER_APP_BASE_URL:
-        # Using Webhook
-        full_webhook_url = f"{RENDER_APP_BASE_URL.rstrip('/')}/{TELEGRAM_TOKEN}"
-        write_breadcrumb(f"run_bot: Starting in WEBHOOK mode. URL: {full_webhook_url}, Port: {port_to_use}, Path: /<TOKEN>")
+    if WEBHOOK_URL:
+        # Using Webhook: no getUpdates round-trip per batch. PTB's webhook server answers 200 as
+        # soon as the update is put on application.update_queue, so slow handlers (file uploads)
+        # don't cause Telegram-side delivery timeouts.
+        _logger.info("run_bot: Starting in WEBHOOK mode. URL: %s, Port: %s, Path: /<TOKEN>", WEBHOOK_URL, port_to_use)
         application.run_webhook(
             listen="0.0.0.0",
             port=port_to_use,
             url_path=TELEGRAM_TOKEN, # The path part of the webhook URL
-            webhook_url=full_webhook_url # The full URL Telegram will call
+            webhook_url=WEBHOOK_URL, # The full URL Telegram will call
+            bootstrap_retries=0,
+            drop_pending_updates=True # Don't replay the backlog that piled up while the bot was down
         )
-        write_breadcrumb("run_bot: Webhook is running.")
+        _logger.info("run_bot: Webhook is running.")
     else:
-        # Using Polling
-        write_breadcrumb("run_bot: RENDER_APP_BASE_URL not set. Starting in POLLING mode.")
+        # Using Polling (long-poll getUpdates; costs one round-trip per batch of updates)
+        _logger.info("run_bot: RENDER_APP_BASE_URL not set. Starting in POLLING mode.")
         application.run_polling()
-        write_breadcrumb("run_bot: Polling is running.")
+        _logger.info("run_bot: Polling is running.")
 
 # --- Script Entry Point -----------------------------------------------------
 if __name__ == "__main__":
-    write_breadcrumb("__main__: Script execution started.")
+    _logger.info("__main__: Script execution started.")
     
     # --- Instance Locking ---
-    # Check if instance lock is explicitly disabled via a marker in this script file.
-    # This is a simple way to allow disabling the lock for debugging without editing instance_lock.py
-    instance_lock_disabled_marker = "# INSTANCE_LOCK_DISABLE_MARKER" 
-    lock_is_disabled_by_marker = False
-    try:
-        with open(__file__, 'r', encoding='utf-8') as f_script_check:
-            if instance_lock_disabled_marker in f_script_check.read():
-                lock_is_disabled_by_marker = True
-                write_breadcrumb("__main__: Instance lock is DISABLED by marker in script file.")
-    except Exception as e_script_check:
-        write_breadcrumb(f"__main__: Error checking for instance_lock_disabled_marker: {e_script_check}")
-
-    if lock_is_disabled_by_marker:
-        # If disabled by marker, try to clean up any existing lock file as a precaution
-        lock_file_path_for_cleanup = os.path.join(BASE_DIR, "bot.lock") # Default lock file name
-        if os.path.exists(lock_file_path_for_cleanup):
-            write_breadcrumb(f"__main__: Instance lock disabled by marker, but lock file '{lock_file_path_for_cleanup}' exists. Attempting removal.")
-            try:
-                os.remove(lock_file_path_for_cleanup)
-                write_breadcrumb(f"__main__: Successfully removed stale lock file: {lock_file_path_for_cleanup}")
-            except OSError as e_remove_stale:
-                write_breadcrumb(f"__main__: Failed to remove stale lock file '{lock_file_path_for_cleanup}' (lock disabled by marker): {e_remove_stale}")
-        
-        write_breadcrumb("__main__: Proceeding without instance lock due to disable marker.")
+    # The lock can be disabled for debugging by setting DISABLE_LOCK_FILE_FOR_DEBUG=1 in .env,
+    # without editing instance_lock.py (load_dotenv has already run at this point).
+    lock_is_disabled = os.getenv("DISABLE_LOCK_FILE_FOR_DEBUG") == "1"
+
+    if lock_is_disabled:
+        _logger.info("__main__: Proceeding without instance lock (DISABLE_LOCK_FILE_FOR_DEBUG=1).")
+        rotate_flow_log()
         run_bot() # Run the bot directly
     else:
         # Proceed with instance lock enabled
-        write_breadcrumb("__main__: Instance lock is ENABLED (no disable marker found).")
-        lock = InstanceLock() # Uses default lock file name "bot.lock" in BASE_DIR
-        if lock.acquire():
-            write_breadcrumb("__main__: Instance lock acquired successfully.")
-            try:
+        _logger.info("__main__: Instance lock is ENABLED (DISABLE_LOCK_FILE_FOR_DEBUG not set).")
+        # InstanceAlreadyRunning means the lock is held; any other failure to create or lock
+        # bot.lock (e.g. a read-only directory) propagates as OSError with its own traceback.
+        try:
+            with InstanceLock(): # Uses default lock file name "bot.lock" in BASE_DIR; released on scope exit
+                rotate_flow_log()
+                _logger.info("__main__: Instance lock acquired successfully.")
                 run_bot()
-            finally:
-                # Ensure lock is released if acquired
-                lock.release()
-                write_breadcrumb("__main__: Instance lock released (in finally block).")
-        else:
-            # This 'else' corresponds to 'if lock.acquire():'
-            # lock.acquire() itself prints messages on failure, so we just add a breadcrumb and exit.
-            write_breadcrumb("__main__: CRITICAL - Failed to acquire instance lock. Bot cannot start. Check previous breadcrumbs/console for details from InstanceLock.")
+            _logger.info("__main__: Instance lock released.")
+        except InstanceAlreadyRunning:
+            # InstanceLock itself logs an error with the holder PID, so we just add a breadcrumb and exit.
+            _logger.info("__main__: CRITICAL - Failed to acquire instance lock. Bot cannot start. Check previous breadcrumbs/console for details from InstanceLock.")
             # Print a consolidated error message to stderr for user visibility if they are not checking breadcrumbs.
             print("CRITICAL: Bot startup failed - Could not acquire instance lock.", file=sys.stderr, flush=True)
-            print("This may be due to another instance running or a stale 'bot.lock' file.", file=sys.stderr, flush=True)
+            print("Another instance is most likely still running (the OS releases the lock when it exits).", file=sys.stderr, flush=True)
             print("Check 'debug_script_flow.txt' and console output for detailed messages from the locking mechanism.", file=sys.stderr, flush=True)
-            print("If safe, manually delete 'bot.lock' or use debug options (DISABLE_LOCK_FILE_FOR_DEBUG in .env / # INSTANCE_LOCK_DISABLE_MARKER in script).", file=sys.stderr, flush=True)
+            print("Stop the other instance, or set DISABLE_LOCK_FILE_FOR_DEBUG=1 in .env to bypass the lock.", file=sys.stderr, flush=True)
             sys.exit(1) # Exit with error code
 
-    write_breadcrumb("__main__: Script execution finished or bot stopped.")
+    _logger.info("__main__: Script execution finished or bot stopped.")